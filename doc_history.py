@@ -3,21 +3,34 @@
 from pymongo.collection import Collection
 from pymongo.read_concern import ReadConcern
 from pymongo.write_concern import WriteConcern
-from pymongo import ReadPreference
+from pymongo import InsertOne, ReplaceOne, ReadPreference
+from pymongo.errors import OperationFailure
+from bson import Binary, ObjectId, decode as bson_decode, encode as bson_encode
+import hashlib
 import logging
-from copy import deepcopy
+import threading
 from datetime import datetime, timezone
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 log = logging.getLogger(__name__)
 
+# Sentinel for dict.pop() so we can tell a missing key from one holding None
+_MISSING = object()
+
 
 class Change:
     (INITIAL, ADD, REMOVE, UPDATE) = list("IARU")
 
 
 class PatchResult(list):
+    __slots__ = ()
+
     def __init__(self, *patches):
-        super().__init__()
+        super().__init__(patches)
 
     def __str__(self):
         return "<PatchResult (patches=[{}])>".format(", ".join([str(i) for i in self]))
@@ -28,21 +41,30 @@ class DocHistoryCollection(Collection):
 
     DEFAULT_num_deltas_before_snapshot = 5
     DEFAULT_internal_metadata_keyname = '__DOC_HISTORY_INTERNAL_METADATA'
+    DEFAULT_patch_many_chunk_size = 500
+
+    _TRANSACTION_OPTIONS = {
+        'read_concern': ReadConcern("local"),
+        'write_concern': WriteConcern("majority", wtimeout=1000),
+        'read_preference': ReadPreference.PRIMARY,
+    }
+
+    # (database name, collection name) pairs we've already ensured indexes on in this process
+    _indexes_created = set()
 
     def __new__(cls, *args, **kwargs):
         """Mainly checks to ensure all subclasses have a PK_FIELDS attribute."""
         if not hasattr(cls, "PK_FIELDS"):
             raise AttributeError("{} is missing PK_FIELDS".format(cls.__name__))
-        return super().__new__(cls)
 
-    @property
-    def _deltas_name(self):
-        return "{}_deltas".format(self.name)
+        if "_filter_fn" not in cls.__dict__:
+            # PK_FIELDS never changes for a class, so build functions that pull those fields straight out of a
+            # doc instead of looping over PK_FIELDS on every call.
+            fields = [repr(k) for k in cls.PK_FIELDS]
+            cls._filter_fn = staticmethod(eval("lambda d: {" + ", ".join(f"{k}: d[{k}]" for k in fields) + "}", {}))
+            cls._key_fn = staticmethod(eval("lambda d: (" + "".join(f"d[{k}], " for k in fields) + ")", {}))
 
-    @property
-    def _deltas_collection(self):
-        """Shortcut property to access the `deltas` collection."""
-        return self.database[self._deltas_name]
+        return super().__new__(cls)
 
     def __init__(self, *args, **kwargs):
         """
@@ -61,6 +83,15 @@ class DocHistoryCollection(Collection):
                                            want a higher number here.  Defaults to 
                                            DEFAULT_num_deltas_before_snapshot. Also the more 
                                            snapshots you have the bigger the collection will be.
+
+        :param compress_snapshots: (Optional) Defaults to False. Store snapshots in the deltas collection as a single
+                                   zstd-compressed blob instead of a full copy of the doc.  Needs the
+                                   `zstandard` package.  Snapshots are only decompressed when replaying
+                                   revisions.
+
+        :param patch_many_chunk_size: (Optional) How many docs `patch_many` patches per transaction.  Defaults to
+                                      DEFAULT_patch_many_chunk_size.  Lower it if your docs are big enough that
+                                      a chunk runs into MongoDB's transaction size limit.
         """
 
         if "name" not in kwargs:
@@ -68,81 +99,115 @@ class DocHistoryCollection(Collection):
 
         self.num_deltas_before_snapshot = kwargs.pop('num_deltas_before_snapshot', DocHistoryCollection.DEFAULT_num_deltas_before_snapshot)
         self.internal_metadata_keyname = kwargs.pop('internal_metadata_keyname', DocHistoryCollection.DEFAULT_internal_metadata_keyname)
+        self.patch_many_chunk_size = kwargs.pop('patch_many_chunk_size', DocHistoryCollection.DEFAULT_patch_many_chunk_size)
+        self.compress_snapshots = kwargs.pop('compress_snapshots', False)
+        if self.compress_snapshots and zstandard is None:
+            raise ImportError("compress_snapshots needs the zstandard package")
+        # zstd (de)compressors can't be shared between threads, so each thread gets its own pair
+        self._zstd = threading.local()
 
         self.timestamp = datetime.now(timezone.utc)
 
+        # Fields that never take part in a diff, and the PK_FIELDS as a set for quick lookups
+        self._ignore_add_rm = frozenset(('_id', self.internal_metadata_keyname))
+        self._ignore_upd = frozenset((self.internal_metadata_keyname,))
+        self._pk_fields_set = frozenset(self.PK_FIELDS)
+
+        # Field paths into the internal metadata (plus our $graphLookup depth field), used in filters and pipelines
+        m = self.internal_metadata_keyname
+        self._f_depth = f"{m}_depth"
+        self._f_prev_delta = f"{m}.previous_delta"
+        self._f_timestamp = f"{m}.timestamp"
+        self._f_ver_major = f"{m}.version.major"
+        self._f_ver_minor = f"{m}.version.minor"
+        self._f_deleted = f"{m}.deleted"
+        self._f_deleted_ts = f"{m}.deleted.timestamp"
+
         super().__init__(*args, **kwargs)
 
+        # Looking up the `deltas` collection builds a new Collection object each time, so do it once here.
+        self._deltas_name = "{}_deltas".format(self.name)
+        self._deltas_collection = self.database[self._deltas_name]
+
+        self._ensure_history_indexes()
+
+    def _ensure_history_indexes(self):
+        """
+        Make sure the indexes the delta chain lookups and the deleted filter rely on exist.
+
+        PK_FIELDS is left alone, since most users already have their own (often unique) index on it.  A failed
+        build (e.g. the user can't create indexes) is logged rather than raised; everything still works without
+        the indexes, just slower.
+        """
+        key = (self.database.name, self._deltas_name)
+        if key in DocHistoryCollection._indexes_created:
+            return
+
+        for (collection, keys) in (
+            (self, [(self._f_deleted_ts, 1)]),
+            (self._deltas_collection, [(self._f_prev_delta, 1)]),
+            (self._deltas_collection, [(self._f_ver_major, 1), (self._f_ver_minor, 1)]),
+        ):
+            try:
+                collection.create_index(keys, background=True)
+            except OperationFailure as e:
+                log.warning("Couldn't create index %s on %s: %s", keys, collection.name, e)
+
+        DocHistoryCollection._indexes_created.add(key)
+
     def _document_filter(self, document):
         """Create a document filter based on the class's PK_FIELDS."""
         try:
-            return dict([(k, document[k]) for k in self.PK_FIELDS])
+            return self._filter_fn(document)
         except KeyError as e:
-            if bool(set(e.args) & set(self.PK_FIELDS)):
+            if not self._pk_fields_set.isdisjoint(e.args):
                 raise KeyError(
                     "Perhaps you forgot to include {} in projection?".format(
                         self.PK_FIELDS
                     )
                 )
 
+    def _document_key(self, document):
+        """Hashable version of the document's PK_FIELDS values."""
+        return self._key_fn(document)
+
     def _check_key(self, *docs):
         """Verify that the same `PK_FIELDS` field is present for every doc."""
-        pks = set()
-        for pk in self.PK_FIELDS:
-            for (i, d) in enumerate(docs):
-                try:
-                    pks.add(d[pk])
-                except KeyError as e:
-                    raise AttributeError("Keys not present: {}".format(pk))
-        if len(list(pks)) > 1:
-            raise AttributeError("Differing keys present: {}".format(list(pks)))
-
-    def _get_additions(self, latest, doc, ignore_fields=None):
-        self._check_key(latest, doc)
-        latest_keyset = set(latest.keys())
-        doc_keyset = set(doc.keys())
-        if not ignore_fields:
-            ignore_fields = []
-
-        ignore_fields += ['_id', self.internal_metadata_keyname]
-
-        for field in ignore_fields:
-            latest_keyset.discard(field)
-            doc_keyset.discard(field)
-
-        return dict([(k, doc[k]) for k in doc_keyset - latest_keyset])
-
-    def _get_updates(self, latest, doc, ignore_fields=None):
-        if not ignore_fields:
-            ignore_fields = []
-
-        ignore_fields += [self.internal_metadata_keyname]
-        return dict(
-            [(k, v) for (k, v) in doc.items() if k in latest and latest[k] != doc[k] and k not in ignore_fields]
-        )
-
-    def _get_removals(self, latest, doc, ignore_fields=None):
-        self._check_key(latest, doc)
-        # This will get all keys that are NOT latest, but are in doc.
-        # We'll be skipping '_id', since that's an internal MongoDB key.
-        if not ignore_fields:
-            ignore_fields = []
-
-        ignore_fields += ["_id", self.internal_metadata_keyname]
-        return [
-            x
-            for x in list(set(latest.keys()) - set(doc.keys()))
-            if x not in ignore_fields
-        ]
+        try:
+            pks = [self._key_fn(d) for d in docs]
+        except KeyError as e:
+            raise AttributeError("Keys not present: {}".format(e.args[0]))
+        if any(pk != pks[0] for pk in pks[1:]):
+            raise AttributeError("Differing keys present: {}".format(pks))
 
-    def _add_patch(self, patch):
-        return self._deltas_collection.insert_one(patch)
+    def _add_patch(self, patch, session=None):
+        return self._deltas_collection.insert_one(patch, session=session)
 
     def _create_deltas(self, last, current, ignore_fields=None):
+        """
+        Diff two versions of a doc in a single pass over `current`.
+
+        :returns: dict of keys in `current` but not `last` (ADD), keys in both whose values differ (UPDATE, with
+                  `current`'s value) and a list of keys in `last` but not `current` (REMOVE).
+        """
+        self._check_key(last, current)
+        # '_id' is an internal MongoDB key, so it's never added or removed.
+        ignore_add_rm = self._ignore_add_rm.union(ignore_fields) if ignore_fields else self._ignore_add_rm
+        ignore_upd = self._ignore_upd.union(ignore_fields) if ignore_fields else self._ignore_upd
+
+        additions = {}
+        updates = {}
+        for (k, v) in current.items():
+            if k in last:
+                if last[k] != v and k not in ignore_upd:
+                    updates[k] = v
+            elif k not in ignore_add_rm:
+                additions[k] = v
+
         return {
-            Change.ADD: self._get_additions(last, current, ignore_fields),
-            Change.UPDATE: self._get_updates(last, current, ignore_fields),
-            Change.REMOVE: self._get_removals(last, current, ignore_fields),
+            Change.ADD: additions,
+            Change.UPDATE: updates,
+            Change.REMOVE: list(last.keys() - current.keys() - ignore_add_rm),
         }
 
     def delete_doc(self, doc):
@@ -176,53 +241,60 @@ class DocHistoryCollection(Collection):
         :param doc: Live document that we want to find the previous version for
 
         :param version_timestamp: The point in time that for which we are attempting to get the version.
-        """
-        doc_revision = None
 
+        :raises RuntimeError: if a delta in the chain is neither a snapshot nor a patch.
+        """
         # if the doc was created after the timestamp then we know it wasn't around back then.
         if doc[self.internal_metadata_keyname]['created']['timestamp'] > version_timestamp:
             return None
 
-        deltas = []
-        base_doc = deepcopy(super().find_one({'_id': doc['_id']}))
+        # Don't bother with the aggregation if the delta chain doesn't even start
+        if self._deltas_collection.count_documents({'_id': doc[self.internal_metadata_keyname]['previous_delta']}, limit=1) == 0:
+            return None
 
-        # Get all the revisions from now until one before version_timestamp
-        delta_id = base_doc[self.internal_metadata_keyname]['previous_delta']
+        # Fetch every delta from now back to version_timestamp in a single round-trip.
+        # $graphLookup doesn't guarantee any order, so we have it tag each delta with its distance from
+        # the live doc and sort on that.  Unwinding gives us one row per delta instead of a single doc holding
+        # the whole chain, which could go over the 16MB doc limit (the server folds the $unwind into the
+        # $graphLookup).  Each row would also carry a copy of the live doc, so we project that away.
+        pipeline = [
+            {'$match': {'_id': doc['_id']}},
+            {'$graphLookup': {
+                'from': self._deltas_name,
+                'startWith': '$' + self._f_prev_delta,
+                'connectFromField': self._f_prev_delta,
+                'connectToField': '_id',
+                'as': 'chain',
+                'depthField': self._f_depth,
+                'restrictSearchWithMatch': {self._f_timestamp: {'$gte': version_timestamp}},
+            }},
+            {'$unwind': '$chain'},
+            {'$project': {'chain': 1}},
+            {'$sort': {'chain.' + self._f_depth: 1}},
+        ]
 
-        while True:
-            delta = self._deltas_collection.find_one({'_id': delta_id})
-            if delta is not None and 'timestamp' in delta[self.internal_metadata_keyname]:
-                if delta[self.internal_metadata_keyname]['timestamp'] < version_timestamp:
-                    # This is our last one.
-                    if delta[self.internal_metadata_keyname]['type'] == 'snapshot':
-                        doc_revision = deepcopy(delta)
-                    else:
-                        deltas.append(deepcopy(delta))
+        meta = self.internal_metadata_keyname
+        base_doc = None
+        deltas = []
+        for row in super().aggregate(pipeline, allowDiskUse=True):
+            delta = row['chain']
+            if delta[meta]['type'] == 'snapshot':
+                deltas.clear()
+                base_doc = self._expand_snapshot(delta)
+            elif 'deltas' in delta[meta]:
+                deltas.append(delta[meta]['deltas'])
+            else:
+                raise RuntimeError(f"malformed delta chain at {delta['_id']}")
 
-                    break
-                elif delta[self.internal_metadata_keyname]['type'] == 'snapshot':
-                    deltas.clear()
-                    base_doc = deepcopy(delta)
-                elif 'deltas' in delta[self.internal_metadata_keyname]:
-                    deltas.append(delta[self.internal_metadata_keyname]['deltas'])
-                else:
-                    # error
-                    print("ERROR ERROR")
-                    break
+        if base_doc is None:
+            # No snapshot since version_timestamp, so the deltas get replayed onto the live doc
+            base_doc = super().find_one({'_id': doc['_id']})
+            if base_doc is None:
+                return None
 
-                if 'previous_delta' in delta[self.internal_metadata_keyname]:
-                    delta_id = delta[self.internal_metadata_keyname]['previous_delta']
-                else:
-                    # We're at the beginning.  Assume that delta[self.internal_metadata_keyname]['type'] == 'snapshot' caught it?
-                    doc_revision = base_doc
-                    break
-            else:
-                # Reached the end and no deltas
-                break
+        doc_revision = self._apply_patches(base_doc, deltas)
 
-        if doc_revision is None:
-            doc_revision = self._apply_patches(base_doc, deltas)
-            
+        doc_revision.pop(self._f_depth, None)
         if self.internal_metadata_keyname in doc_revision:
             del doc_revision[self.internal_metadata_keyname]
 
@@ -237,15 +309,15 @@ class DocHistoryCollection(Collection):
         :param deltas: a list of deltas
         """
         for delta in deltas:
-            for (k, v) in delta.get(Change.ADD, {}).items():
-                doc[k] = v
-            for (k, v) in delta.get(Change.UPDATE, {}).items():
-                doc[k] = v
-            for k in delta.get(Change.REMOVE, []):
-                if k not in doc:
+            adds = delta.get(Change.ADD)
+            if adds:
+                doc.update(adds)
+            updates = delta.get(Change.UPDATE)
+            if updates:
+                doc.update(updates)
+            for k in delta.get(Change.REMOVE, ()):
+                if doc.pop(k, _MISSING) is _MISSING and log.isEnabledFor(logging.WARNING):
                     log.warning("'%s' wasn't in instance %s. This was unexpected, so skipping.", k, doc)
-                else:
-                    del doc[k]
         return doc
 
 
@@ -263,57 +335,80 @@ class DocHistoryCollection(Collection):
         # TODO This is broken
         doc = None
 
-        # Get the first one
-        starting_revision = self._deltas_collection.find_one({
-            f"{self.internal_metadata_keyname}.version.major": version_major,
-            f"{self.internal_metadata_keyname}.version.minor": version_minor
-        })
+        # Get the first one along with the deltas that follow it, up to where the next snapshot usually is.
+        pipeline = [
+            {'$match': {
+                self._f_ver_major: version_major,
+                self._f_ver_minor: version_minor
+            }},
+            {'$limit': 1},
+            {'$graphLookup': {
+                'from': self._deltas_name,
+                'startWith': '$_id',
+                'connectFromField': '_id',
+                'connectToField': self._f_prev_delta,
+                'as': 'chain',
+                'depthField': self._f_depth,
+                'maxDepth': self.num_deltas_before_snapshot,
+            }},
+            {'$unwind': {'path': '$chain', 'preserveNullAndEmptyArrays': True}},
+            {'$sort': {'chain.' + self._f_depth: 1}},
+        ]
+        starting_revision = None
+        chain = []
+        for row in self._deltas_collection.aggregate(pipeline):
+            revision = row.pop('chain', None)
+            if starting_revision is None:
+                starting_revision = row
+            if revision is not None:
+                chain.append(revision)
+
         if starting_revision:
             if starting_revision[self.internal_metadata_keyname]['type'] == 'snapshot':
                 # We are at the snapshot.  There is nothing to do
-                starting_revision.discard('_id')
-                metadata = starting_revision[self.internal_metadata_keyname]
-                starting_revision.discard(self.internal_metadata_keyname)
+                self._expand_snapshot(starting_revision)
+                starting_revision.pop('_id', None)
+                metadata = starting_revision.pop(self.internal_metadata_keyname)
                 # Add back in the metadata and version
                 starting_revision[self.internal_metadata_keyname] = {'version': metadata['version'], 'metadata': metadata['metadata']}
-                doc = deepcopy(starting_revision)
+                doc = starting_revision
             else:
                 # 1) Find the next snapshot AFTER the version
                 # 2) walk back to the version
                 after_snapshot = None
                 deltas = [starting_revision]
-                delta_id = starting_revision['_id']
-                while True:
-                    revision = self._deltas_collection.find_one({f"{self.internal_metadata_keyname}.previous_delta": delta_id})
-                    if revision:
+                for revision in chain:
+                    revision.pop(self._f_depth, None)
+                    if revision[self.internal_metadata_keyname]['type'] == 'snapshot':
+                        # Found it!  We can stop now.
+                        after_snapshot = self._expand_snapshot(revision)
+                        break
+                    else:
+                        # Just add it to deltas and grab the next one
+                        deltas.append(revision)
+
+                if not after_snapshot:
+                    # The snapshot can be further along than our num_deltas_before_snapshot (that setting isn't
+                    # stored with the data, and live docs from before deltas_since_snapshot restarted their count),
+                    # so carry on one hop at a time from where the lookup stopped.
+                    while True:
+                        revision = self._deltas_collection.find_one({self._f_prev_delta: deltas[-1]['_id']})
+                        if not revision:
+                            break
                         if revision[self.internal_metadata_keyname]['type'] == 'snapshot':
-                            # Found it!  We can stop now.
-                            after_snapshot = revision
+                            after_snapshot = self._expand_snapshot(revision)
                             break
-                        else:
-                            # Just add it to deltas and grab the next one
-                            deltas.append(revision)
-                            delta_id = revision['_id']
-                    else:
-                        break
+                        deltas.append(revision)
 
                 if not after_snapshot:
                     # If we are here that means there are no "after" snapshots.  Lets use the live version.
-                    after_snapshot = super().find_one({f"{self.internal_metadata_keyname}.previous_delta": deltas[-1]['_id']})
+                    after_snapshot = super().find_one({self._f_prev_delta: deltas[-1]['_id']})
 
                 if after_snapshot:
-                    doc = deepcopy(after_snapshot)
+                    doc = after_snapshot
                     deltas.reverse()
                     for delta in deltas:
-                        for (k, v) in delta['deltas'].get(Change.ADD, {}).items():
-                            doc[k] = v
-                        for (k, v) in delta['deltas'].get(Change.UPDATE, {}).items():
-                            doc[k] = v
-                        for k in delta['deltas'].get(Change.REMOVE, []):
-                            if k not in doc:
-                                log.warning("'%s' wasn't in instance %s. This was unexpected, so skipping.", k, doc)
-                            else:
-                                del doc[k]
+                        self._apply_patches(doc, [delta[self.internal_metadata_keyname]['deltas']])
 
                         # Lets include version and metadata in there
                         doc[self.internal_metadata_keyname]['version'] = delta[self.internal_metadata_keyname]['version']
@@ -323,7 +418,166 @@ class DocHistoryCollection(Collection):
 
         return doc
 
-    def _do_patch_callback(self, session, doc, metadata, force, ignore_fields, **kwargs):
+    def _has_history(self, latest):
+        """Is `latest` a live doc that we're already keeping track of?"""
+        return bool(latest) and self.internal_metadata_keyname in latest
+
+    def _snapshot(self, doc, snapshot_metadata):
+        """
+        Build a snapshot record of the doc for the deltas collection.
+
+        :param doc: The doc to snapshot.
+
+        :param snapshot_metadata: dict to use as the snapshot's internal metadata field.
+        """
+        if self.compress_snapshots:
+            payload = {k: v for (k, v) in doc.items() if k not in self._ignore_add_rm}
+            encoded = bson_encode(payload, codec_options=self.codec_options)
+            snapshot_metadata['payload'] = Binary(self._zstd_compressor().compress(encoded))
+            snapshot = {}
+        else:
+            # Only top-level keys get touched, so a shallow copy will do
+            snapshot = doc.copy()
+
+        snapshot['_id'] = ObjectId()
+        snapshot[self.internal_metadata_keyname] = snapshot_metadata
+        return snapshot
+
+    def _expand_snapshot(self, snapshot):
+        """Put a compressed snapshot's fields back on the record (in place).  Uncompressed ones are left alone."""
+        payload = snapshot[self.internal_metadata_keyname].pop('payload', None)
+        if payload is not None:
+            if zstandard is None:
+                raise ImportError("Reading compressed snapshots needs the zstandard package")
+            snapshot.update(bson_decode(self._zstd_decompressor().decompress(payload), codec_options=self.codec_options))
+        return snapshot
+
+    def _zstd_compressor(self):
+        if not hasattr(self._zstd, 'compressor'):
+            self._zstd.compressor = zstandard.ZstdCompressor()
+        return self._zstd.compressor
+
+    def _zstd_decompressor(self):
+        if not hasattr(self._zstd, 'decompressor'):
+            self._zstd.decompressor = zstandard.ZstdDecompressor()
+        return self._zstd.decompressor
+
+    def _content_hash(self, doc):
+        """
+        Hash of all the doc's fields we keep history for.  It's stored on the live doc so an unchanged doc can be
+        spotted without fetching or diffing the whole thing.  Python's hash() is salted per process, so this is a
+        digest of the BSON (encoded the same way the collection would) instead.
+
+        The hash is only updated by patches made through this library.  After writing to the live collection
+        directly (update_one, replace_one, ...), a doc that matches the content from before that write will be
+        skipped as unchanged.  It isn't checked when a patch passes ignore_fields.
+        """
+        content = {k: doc[k] for k in sorted(doc.keys() - self._ignore_add_rm)}
+        return hashlib.sha1(bson_encode(content, codec_options=self.codec_options)).hexdigest()
+
+    def _build_patch(self, doc, latest, metadata, force, ignore_fields, timestamp, content_hash=None):
+        """
+        Compare the doc with the latest version and build the delta and the new live doc.  Nothing is written here.
+
+        :param doc: doc object to compare with the latest version in the collection.  Its internal metadata field
+                    gets set in place.
+
+        :param latest: The latest version of the doc in the collection, or None if there isn't one.
+
+        :param timestamp: datetime to stamp the delta and the live doc with.
+
+        :param content_hash: (Optional) The doc's `_content_hash`, if the caller already worked it out.
+
+        :returns: tuple of (delta, doc) or None if there is nothing to patch.
+        """
+        meta = self.internal_metadata_keyname
+        if content_hash is None:
+            content_hash = self._content_hash(doc)
+
+        if not self._has_history(latest):
+            # No doc with PK_FIELDS, so let's add one and create an initial snapshot
+            doc_patch = self._snapshot(doc, {
+                'type': 'snapshot',
+                'version': {
+                    'major': 0,
+                    'minor': 0
+                }, 
+                'timestamp': timestamp,
+                'metadata': None
+            })
+            doc[meta] = {
+                    'previous_delta': doc_patch['_id'],
+                    'version': {
+                        'major': 1, 
+                        'minor': 0
+                    }, 
+                    'deltas_since_snapshot': 0,
+                    'content_hash': content_hash,
+                    'deleted': None,
+                    'created': {'timestamp': timestamp, 'metadata': metadata},
+                    'updated': {'timestamp': timestamp, 'metadata': metadata},
+                    }
+            return (doc_patch, doc)
+
+        if not (force or ignore_fields) and latest[meta].get('content_hash') == content_hash:
+            # Nothing changed since the last patch, no need to diff.  The hash covers every field, so when some of
+            # them are being ignored we leave it to the diff.
+            return None
+
+        # An exising doc exists.  Lets create a patch and then determine if we need to update it.
+        deltas = self._create_deltas(doc, latest, ignore_fields)
+
+        if not (deltas['A'] or deltas['R'] or deltas['U'] or force):
+            return None
+
+        # there was a delta or the force flag was passed.  Let's build a patch then update the live doc
+        # If we are self.num_deltas_before_snapshot due, dump the whole doc as the patch. otherwise patch as normal
+        # Live docs from before we kept count are treated as having just been snapshotted.
+        deltas_since_snapshot = latest[meta].get('deltas_since_snapshot', 0) + 1
+        if deltas_since_snapshot >= self.num_deltas_before_snapshot:
+            # We are due.  Let's create one now.
+            deltas_since_snapshot = 0
+            patch = self._snapshot(doc, {
+                'previous_delta': latest[meta]['previous_delta'],
+                'type': 'snapshot',
+                'version': latest[meta]['version'],  # snag the live version
+                'timestamp': timestamp,
+                'metadata': latest[meta]['updated']['metadata']
+            })
+            version = {
+                'major': latest[meta]['version']['major'] + 1,
+                'minor': 0
+            }
+        else:
+            # Create the patch like normal
+            patch = {
+                '_id': ObjectId(),
+                meta: {
+                    'previous_delta': latest[meta]['previous_delta'],
+                    'type': 'patch',
+                    'deltas': deltas,
+                    'version': latest[meta]['version'],
+                    'timestamp': timestamp,
+                    'metadata': latest[meta]['updated']['metadata'],
+                }
+            }
+            version = {
+                'major': latest[meta]['version']['major'],
+                'minor': latest[meta]['version']['minor'] + 1
+            }
+
+        doc[meta] = {
+            'previous_delta': patch['_id'],
+            'version': version,
+            'deltas_since_snapshot': deltas_since_snapshot,
+            'content_hash': content_hash,
+            'deleted': None,
+            'created': latest[meta].get('created', {'timestamp': timestamp, 'metadata': None}),
+            'updated': {'timestamp': timestamp, 'metadata': metadata}
+        }
+        return (patch, doc)
+
+    def _do_patch_callback(self, session, doc, metadata, force, ignore_fields, timestamp, **kwargs):
         """
         Transaction callback for comparing the doc with the latest version and updating/patching if necessary.
 
@@ -341,125 +595,80 @@ class DocHistoryCollection(Collection):
         :param ignore_fields: (Optional) list of fields to ignore when comparing the latest doc in the collection
                               with the doc that was passed in here.
 
+        :param timestamp: datetime to stamp this change with.
+
         """
         # This seems like a lot to do in a single transaction... the db will be locked during this time?
 
         fltr = self._document_filter(doc)
-        latest = super().find_one(fltr, **kwargs)
+        content_hash = self._content_hash(doc)
 
-        patch_result = None
-
-        if latest is None or (not len(latest)) or self.internal_metadata_keyname not in latest:
-            # No doc with PK_FIELDS, so let's add one and create an initial snapshot
-
-            # Create and add the patch
-            doc_patch = deepcopy(doc)
-            doc_patch[self.internal_metadata_keyname] = {
-                'type': 'snapshot',
-                'version': {
-                    'major': 0,
-                    'minor': 0
-                }, 
-                'timestamp': self.timestamp,
-                'metadata': None
-            }
-            new_patch_result = self._add_patch(doc_patch)
-
-            if new_patch_result:
-                # if the patch is successful, lets add the real doc
-                doc[self.internal_metadata_keyname] = {
-                        'previous_delta': new_patch_result.inserted_id,
-                        'version': {
-                            'major': 1, 
-                            'minor': 0
-                        }, 
-                        'deleted': None,
-                        'created': {'timestamp': self.timestamp, 'metadata': metadata},
-                        'updated': {'timestamp': self.timestamp, 'metadata': metadata},
-                        }
-                result = super().insert_one(doc, **kwargs)
-                patch_result = PatchResult(result)
+        if force or ignore_fields:
+            latest = super().find_one(fltr, session=session, **kwargs)
         else:
-            # An exising doc exists.  Lets create a patch and then determine if we need to update it.
-            deltas = self._create_deltas(doc, latest, ignore_fields)
-
-            if deltas['A'] or deltas['R'] or deltas['U'] or force:
-                # there was a delta or the force flag was passed.  Let's add a patch to the collection then update the live doc
-                # If we are self.num_deltas_before_snapshot due, dump the whole doc as the patch. otherwise patch as normal
-                delta_id = latest[self.internal_metadata_keyname]['previous_delta']
-
-                i = 1
-                while i < self.num_deltas_before_snapshot:
-                    # Look for a snapshot less than self.num_deltas_before_snapshot deltas back starting from the previous_delta of live doc
-                    delta = self._deltas_collection.find_one({'_id': delta_id})
-                    if delta:
-                        if delta[self.internal_metadata_keyname]['type'] == 'snapshot':
-                            # We found a recent snapshot.  We're good.
-                            break
-                        else:
-                            delta_id = delta[self.internal_metadata_keyname]['previous_delta']
-                            if not delta_id:
-                                # error
-                                break
-                    else:
-                        break
+            # Just grab the internal metadata first.  If the content hash matches there's nothing to do, and a new
+            # doc doesn't need anything more to be snapshotted, so only a changed doc pulls the whole thing over.
+            latest = super().find_one(fltr, {'_id': 1, self.internal_metadata_keyname: 1}, session=session, **kwargs)
+            if self._has_history(latest):
+                if latest[self.internal_metadata_keyname].get('content_hash') == content_hash:
+                    return None
+                latest = super().find_one(fltr, session=session, **kwargs)
 
-                    i += 1
-
-                if i == self.num_deltas_before_snapshot:
-                    # We made it all the way before finding a snapshot and we are due.  Let's create one now.
-                    doc_patch = deepcopy(doc)
-                    doc_patch[self.internal_metadata_keyname] = {
-                        'previous_delta': latest[self.internal_metadata_keyname]['previous_delta'],
-                        'type': 'snapshot',
-                        'version': latest[self.internal_metadata_keyname]['version'],  # snag the live version
-                        'timestamp': self.timestamp,
-                        'metadata': latest[self.internal_metadata_keyname]['metadata']
-                    }
-                    new_patch_result = self._add_patch(doc_patch)
-
-                    if new_patch_result:
-                        doc[self.internal_metadata_keyname] = {
-                            'previous_delta': new_patch_result.inserted_id,
-                            'version': {
-                                'major': latest[self.internal_metadata_keyname]['version']['major'] + 1,
-                                'minor': 0
-                            },
-                            'deleted': None,
-                            'created': latest[self.internal_metadata_keyname].get('created', {'timestamp': self.timestamp, 'metadata': None}),
-                            'updated': {'timestamp': self.timestamp, 'metadata': metadata}
-                        }
-                        result = super().replace_one({'_id': latest['_id']}, doc)
-                        patch_result = PatchResult(result)
+        patch_result = None
+
+        patch = self._build_patch(doc, latest, metadata, force, ignore_fields, timestamp, content_hash)
+        if patch:
+            (delta, doc) = patch
+            if self._add_patch(delta, session=session):
+                # if the patch is successful, lets add/update the real doc
+                if self._has_history(latest):
+                    result = super().replace_one({'_id': latest['_id']}, doc, session=session)
                 else:
-                    # Create the patch like normal
-                    patch = {
-                        self.internal_metadata_keyname: {
-                            'previous_delta': latest[self.internal_metadata_keyname]['previous_delta'],
-                            'type': 'patch',
-                            'deltas': deltas,
-                            'version': latest[self.internal_metadata_keyname]['version'],
-                            'timestamp': self.timestamp,
-                            'metadata': latest[self.internal_metadata_keyname]['updated']['metadata'],
-                        }
-                    }
-                    result = self._add_patch(patch)
-
-                    if result:
-                        doc[self.internal_metadata_keyname] = {
-                            'previous_delta': result.inserted_id,
-                            'version': {
-                                'major': latest[self.internal_metadata_keyname]['version']['major'],
-                                'minor': latest[self.internal_metadata_keyname]['version']['minor'] + 1
-                            },
-                            'deleted': None,
-                            'created': latest[self.internal_metadata_keyname].get('created', {'timestamp': self.timestamp, 'metadata': None}),
-                            'updated': {'timestamp': self.timestamp, 'metadata': metadata}
-                        }
-                        patch_result = PatchResult(super().replace_one({'_id': latest['_id']}, doc))
+                    result = super().insert_one(doc, session=session, **kwargs)
+                patch_result = PatchResult(result)
 
         return patch_result
 
+    def _do_patch_many_callback(self, session, docs, metadata, force, ignore_fields, timestamp, **kwargs):
+        """
+        Transaction callback for patching a batch of docs with a single lookup and bulk writes.
+
+        Same parameters as `_do_patch_callback`, except `docs` is a list of doc objects.
+        """
+        # Grab the latest version of every doc in one query and do all the diffing locally
+        latest_docs = {}
+        for latest in super().find({'$or': [self._document_filter(d) for d in docs]}, session=session, **kwargs):
+            latest_docs[self._document_key(latest)] = latest
+
+        delta_ops = []
+        live_ops = []
+        for doc in docs:
+            key = self._document_key(doc)
+            latest = latest_docs.get(key)
+            patch = self._build_patch(doc, latest, metadata, force, ignore_fields, timestamp)
+            if not patch:
+                continue
+
+            (delta, doc) = patch
+            delta_ops.append(InsertOne(delta))
+            if self._has_history(latest):
+                # Keep the live _id on the doc so a repeat of it further down can replace it too
+                doc['_id'] = latest['_id']
+                live_ops.append(ReplaceOne({'_id': latest['_id']}, doc))
+            else:
+                doc.setdefault('_id', ObjectId())
+                live_ops.append(InsertOne(doc))
+
+            # In case the same doc shows up again further down the list
+            latest_docs[key] = doc
+
+        if not delta_ops:
+            return None
+
+        # The deltas don't depend on each other, but the live ops need to stay in order if a doc repeats.
+        self._deltas_collection.bulk_write(delta_ops, ordered=False, session=session)
+        return super().bulk_write(live_ops, session=session)
+
     def patch_one(self, *args, **kwargs):
         """
         Patch one document.
@@ -476,21 +685,30 @@ class DocHistoryCollection(Collection):
         :param metadata: (Optional) Defaults to None. dict of attributes to attach to the doc record in its internal
                          metadata field.
 
+        :param session: (Optional) Defaults to None. MongoClient session object that already has a transaction
+                        running.  If given, the patch is done as part of that transaction instead of its own.
+
         """
         doc = args[0]
         force = kwargs.pop("force", False)
         ignore_fields = kwargs.pop("ignore_fields", None)
         metadata = kwargs.pop("metadata", None)
+        session = kwargs.pop("session", None)
+
+        # Each call is its own logical change, so it gets its own timestamp.  It's kept local rather than on the
+        # instance since collections are usually shared between threads.
+        timestamp = datetime.now(timezone.utc)
+
+        if session is not None:
+            return self._do_patch_callback(session, doc, metadata, force, ignore_fields, timestamp, **kwargs)
 
         result = None
         with self.database.client.start_session() as session:
             result = session.with_transaction(
                 lambda session: self._do_patch_callback(session, doc, metadata,
-                                                        force, ignore_fields,
+                                                        force, ignore_fields, timestamp,
                                                         **kwargs),
-                read_concern=ReadConcern("local"),
-                write_concern=WriteConcern("majority", wtimeout=1000),
-                read_preference=ReadPreference.PRIMARY,
+                **self._TRANSACTION_OPTIONS
             )
 
         return result
@@ -499,7 +717,7 @@ class DocHistoryCollection(Collection):
         """
         Patch an array of docs
 
-        :param docs: A list of document objects to patch
+        :param docs: A list (or any other iterable) of document objects to patch
 
         :param missing_mark_deleted: (Optional) Defaults to False. This function can optionally scan the collection
                                      for any documents NOT passed in through docs and mark them as deleted.
@@ -515,51 +733,52 @@ class DocHistoryCollection(Collection):
         :param metadata: (Optional) Defaults to None. dict of attributes to attach to the doc record in its internal
                          metadata field.
 
+        :returns: list with a pymongo BulkWriteResult for every chunk of docs (see patch_many_chunk_size) that had
+                  anything to patch, followed by the UpdateResult of marking docs deleted if missing_mark_deleted
+                  was set.
 
         """
         missing_mark_deleted = kwargs.pop("missing_mark_deleted", False)
         missing_mark_deleted_filter = kwargs.pop("missing_mark_deleted_filter", {})
-        metadata = kwargs.get("metadata", {})
+        force = kwargs.pop("force", False)
+        ignore_fields = kwargs.pop("ignore_fields", None)
+        metadata = kwargs.pop("metadata", None)
+
+        # We chunk by index and go over the docs again for missing_mark_deleted, so generators/cursors need to be
+        # pulled into a list first
+        docs = list(docs)
+
+        # Every delta, snapshot and deleted flag in the batch shares this one timestamp
+        timestamp = datetime.now(timezone.utc)
 
         result = []
-        for doc in docs:
-            one = self.patch_one(doc, *args, **kwargs)
-            if one:
-                result.append(one)
+        if docs:
+            # One session for the whole batch, with a transaction per chunk so we stay under the transaction size limit
+            with self.database.client.start_session() as session:
+                for i in range(0, len(docs), self.patch_many_chunk_size):
+                    chunk = docs[i:i + self.patch_many_chunk_size]
+                    chunk_result = session.with_transaction(
+                        lambda session: self._do_patch_many_callback(session, chunk, metadata,
+                                                                     force, ignore_fields, timestamp,
+                                                                     **kwargs),
+                        **self._TRANSACTION_OPTIONS
+                    )
+                    if chunk_result:
+                        result.append(chunk_result)
 
         if missing_mark_deleted:
-            # Get a list of docs in the collection that are not already marked as deleted
-            # first get a list of PKs from passed-in docs
-            db_filter = {}
-            for pk in self.PK_FIELDS:
-                db_filter.update({pk: 1})
-
-            existing_pks = {}
-            for pk in self.PK_FIELDS:
-                existing_pks.update({ pk: [] })
-                for row in docs:
-                    existing_pks[pk].append(row[pk])
-
-            # Then lookup in this collection anything thats not in the list
-            db_filter = []
-            for pk in self.PK_FIELDS:
-                db_filter.append({ pk: {'$not': { '$in': existing_pks[pk] } }})
-
-            db_filter.append({f"{self.internal_metadata_keyname}.deleted.timestamp": None})
-
-            missing_docs = super().find({ '$and': db_filter })
-
-            missing_ids = []
-            for md in missing_docs:
-                missing_ids.append(md['_id'])
-
-            # For all those, update the metadata to be deleted
-            if missing_ids:
-                if missing_mark_deleted_filter:
-                    db_filter = { '$and': [ missing_mark_deleted_filter, {'_id': {'$in': missing_ids}} ]}
-                else:
-                    db_filter = {'_id': {'$in': missing_ids}}
-
-                result.append(super().update_many(db_filter, {'$set': {f"{self.internal_metadata_keyname}.deleted": {'timestamp': self.timestamp, 'metadata': metadata}}}))
+            # Mark deleted anything in the collection that's not already marked as deleted and whose
+            # PK values (all together) aren't in the passed-in docs.  The server does the matching, so
+            # nothing needs to come back over the wire first.
+            existing_pks = [[d[pk] for pk in self.PK_FIELDS] for d in docs]
+            db_filter = [
+                {self._f_deleted_ts: None},
+                # $literal so PK values that look like field paths or expressions are compared as plain values
+                {'$expr': {'$not': {'$in': [['$' + pk for pk in self.PK_FIELDS], {'$literal': existing_pks}]}}},
+            ]
+            if missing_mark_deleted_filter:
+                db_filter.append(missing_mark_deleted_filter)
+
+            result.append(super().update_many({'$and': db_filter}, {'$set': {self._f_deleted: {'timestamp': timestamp, 'metadata': metadata or {}}}}))
 
         return result
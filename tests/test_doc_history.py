@@ -0,0 +1,351 @@
+import unittest
+import uuid
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+import doc_history
+from doc_history import DocHistoryCollection
+
+META = DocHistoryCollection.DEFAULT_internal_metadata_keyname
+
+
+class Contacts(DocHistoryCollection):
+    PK_FIELDS = ['email']
+
+
+class Accounts(DocHistoryCollection):
+    PK_FIELDS = ['tenant', 'it\'s "quoted"']
+
+
+def fake_session():
+    """A session whose transactions just run the callback."""
+    session = mock.MagicMock()
+    session.with_transaction.side_effect = lambda callback, **kwargs: callback(session)
+    return session
+
+
+def make_collection(client_options=None, cls=Contacts, **kwargs):
+    """A Contacts (or `cls`) collection that never talks to a server."""
+    db = MongoClient(connect=False, **(client_options or {}))['doc_history_test']
+    with mock.patch.object(Collection, 'create_index'):
+        return cls(database=db, **kwargs)
+
+
+class EnsureHistoryIndexesTest(unittest.TestCase):
+    def setUp(self):
+        indexes_created = mock.patch.object(DocHistoryCollection, '_indexes_created', set())
+        indexes_created.start()
+        self.addCleanup(indexes_created.stop)
+        self.db = MongoClient(connect=False)['doc_history_test']
+
+    def test_creates_history_indexes_once(self):
+        with mock.patch.object(Collection, 'create_index', autospec=True) as create_index:
+            Contacts(database=self.db)
+            Contacts(database=self.db)
+
+        self.assertEqual(
+            [(c.args[0].name, c.args[1]) for c in create_index.call_args_list],
+            [('Contacts', [(META + '.deleted.timestamp', 1)]),
+             ('Contacts_deltas', [(META + '.previous_delta', 1)]),
+             ('Contacts_deltas', [(META + '.version.major', 1), (META + '.version.minor', 1)])],
+        )
+
+    def test_index_build_failures_are_logged_not_raised(self):
+        with mock.patch.object(Collection, 'create_index', side_effect=OperationFailure('not authorized')), \
+                self.assertLogs(doc_history.log, 'WARNING') as logs:
+            coll = Contacts(database=self.db)
+
+        self.assertEqual(coll.name, 'Contacts')
+        self.assertEqual(len(logs.records), 3)
+
+
+def live_doc(**fields):
+    """A live doc as a previous patch would have left it."""
+    return dict(fields, _id=ObjectId(), **{META: {
+        'previous_delta': ObjectId(),
+        'version': {'major': 1, 'minor': 0},
+        'deltas_since_snapshot': 0,
+        'deleted': None,
+        'created': {'timestamp': datetime.now(), 'metadata': None},
+        'updated': {'timestamp': datetime.now(), 'metadata': None},
+    }})
+
+
+class CompoundPkTest(unittest.TestCase):
+    def setUp(self):
+        self.coll = make_collection(cls=Accounts)
+        self.quoted = Accounts.PK_FIELDS[1]
+
+    def test_filter_and_key_pull_every_pk_field(self):
+        doc = {'tenant': 't1', self.quoted: 7, 'name': 'x'}
+        self.assertEqual(self.coll._document_filter(doc), {'tenant': 't1', self.quoted: 7})
+        self.assertEqual(self.coll._document_key(doc), ('t1', 7))
+
+    def test_missing_pk_field(self):
+        with self.assertRaisesRegex(KeyError, 'Perhaps you forgot'):
+            self.coll._document_filter({'tenant': 't1'})
+        with self.assertRaisesRegex(AttributeError, 'Keys not present'):
+            self.coll._check_key({'tenant': 't1', self.quoted: 7}, {'tenant': 't1'})
+
+    def test_check_key_compares_whole_pk_tuples(self):
+        # Different values within one PK are fine, as long as every doc has the same PK
+        self.coll._check_key({'tenant': 't1', self.quoted: 7}, {'tenant': 't1', self.quoted: 7, 'name': 'x'})
+        with self.assertRaisesRegex(AttributeError, 'Differing keys'):
+            self.coll._check_key({'tenant': 't1', self.quoted: 7}, {'tenant': 't1', self.quoted: 8})
+
+
+class GetRevisionByDateTest(unittest.TestCase):
+    def test_replays_unwound_chain_in_depth_order(self):
+        coll = make_collection()
+        now = datetime.now()
+        live = {
+            '_id': ObjectId(), 'email': 'a', 'name': 'new',
+            META: {'previous_delta': ObjectId(), 'created': {'timestamp': now - timedelta(days=2)}},
+        }
+        rows = [
+            {'_id': live['_id'], 'chain': {'_id': ObjectId(), coll._f_depth: 0,
+                                           META: {'type': 'patch', 'deltas': {'A': {}, 'U': {'name': 'mid'}, 'R': []}}}},
+            {'_id': live['_id'], 'chain': {'_id': ObjectId(), coll._f_depth: 1,
+                                           META: {'type': 'patch', 'deltas': {'A': {'old': 1}, 'U': {'name': 'old'}, 'R': []}}}},
+        ]
+        with mock.patch.object(Collection, 'count_documents', return_value=1), \
+                mock.patch.object(Collection, 'aggregate', return_value=iter(rows)) as aggregate, \
+                mock.patch.object(Collection, 'find_one', return_value=dict(live)) as find_one:
+            revision = coll.get_revision_by_date(live, now - timedelta(days=1))
+
+        pipeline = aggregate.call_args[0][0]
+        self.assertEqual(pipeline[2:4], [{'$unwind': '$chain'}, {'$project': {'chain': 1}}])
+        self.assertEqual(find_one.call_count, 1)
+        self.assertEqual(revision, {'_id': live['_id'], 'email': 'a', 'name': 'old', 'old': 1})
+
+    def test_snapshot_in_chain_skips_the_live_doc(self):
+        coll = make_collection()
+        now = datetime.now()
+        live = {
+            '_id': ObjectId(), 'email': 'a', 'name': 'new',
+            META: {'previous_delta': ObjectId(), 'created': {'timestamp': now - timedelta(days=2)}},
+        }
+        snapshot_id = ObjectId()
+        rows = [
+            {'_id': live['_id'], 'chain': {'_id': snapshot_id, 'email': 'a', 'name': 'mid', coll._f_depth: 0,
+                                           META: {'type': 'snapshot'}}},
+            {'_id': live['_id'], 'chain': {'_id': ObjectId(), coll._f_depth: 1,
+                                           META: {'type': 'patch', 'deltas': {'A': {}, 'U': {'name': 'old'}, 'R': []}}}},
+        ]
+        with mock.patch.object(Collection, 'count_documents', return_value=1), \
+                mock.patch.object(Collection, 'aggregate', return_value=iter(rows)), \
+                mock.patch.object(Collection, 'find_one') as find_one:
+            revision = coll.get_revision_by_date(live, now - timedelta(days=1))
+
+        find_one.assert_not_called()
+        self.assertEqual(revision, {'_id': snapshot_id, 'email': 'a', 'name': 'old'})
+
+    def test_no_deltas_since_timestamp_returns_live_doc(self):
+        coll = make_collection()
+        now = datetime.now()
+        live = {
+            '_id': ObjectId(), 'email': 'a', 'name': 'same',
+            META: {'previous_delta': ObjectId(), 'created': {'timestamp': now - timedelta(days=2)}},
+        }
+        with mock.patch.object(Collection, 'count_documents', return_value=1), \
+                mock.patch.object(Collection, 'aggregate', return_value=iter([])), \
+                mock.patch.object(Collection, 'find_one', return_value=dict(live)):
+            revision = coll.get_revision_by_date(live, now - timedelta(days=1))
+
+        self.assertEqual(revision, {'_id': live['_id'], 'email': 'a', 'name': 'same'})
+
+
+class GetRevisionByVersionTest(unittest.TestCase):
+    def test_snapshot_at_version_is_returned_without_internal_ids(self):
+        coll = make_collection()
+        snapshot = {'_id': ObjectId(), 'email': 'a', 'name': 'old',
+                    META: {'type': 'snapshot', 'version': {'major': 1, 'minor': 0}, 'metadata': None}}
+        with mock.patch.object(Collection, 'aggregate', return_value=iter([snapshot])):
+            revision = coll.get_revision_by_version({}, 1, 0)
+
+        self.assertEqual(revision, {'email': 'a', 'name': 'old',
+                                    META: {'version': {'major': 1, 'minor': 0}, 'metadata': None}})
+
+
+@unittest.skipIf(doc_history.zstandard is None, "zstandard isn't installed")
+class CompressedSnapshotTest(unittest.TestCase):
+    def test_round_trip_uses_the_collection_codec_options(self):
+        coll = make_collection(client_options={'uuidRepresentation': 'standard', 'tz_aware': True},
+                               compress_snapshots=True)
+        doc = {'email': 'a', 'token': uuid.uuid4(), 'when': datetime.now(timezone.utc).replace(microsecond=0)}
+        snapshot = coll._snapshot(doc, {'type': 'snapshot'})
+        self.assertEqual(set(snapshot), {'_id', META})
+
+        expanded = coll._expand_snapshot(snapshot)
+        self.assertEqual(expanded['token'], doc['token'])
+        self.assertEqual(expanded['when'], doc['when'])
+        self.assertNotIn('payload', expanded[META])
+
+
+class ContentHashTest(unittest.TestCase):
+    def test_uses_the_collection_codec_options(self):
+        coll = make_collection(client_options={'uuidRepresentation': 'standard'})
+        doc = {'email': 'a', 'token': uuid.uuid4()}
+        self.assertEqual(coll._content_hash(doc), coll._content_hash(dict(doc)))
+
+    def test_ignores_id_and_internal_metadata(self):
+        coll = make_collection()
+        self.assertEqual(coll._content_hash({'email': 'a'}),
+                         coll._content_hash({'email': 'a', '_id': ObjectId(), META: {'x': 1}}))
+
+
+class SnapshotCountTest(unittest.TestCase):
+    def build(self, coll, latest, n):
+        (delta, doc) = coll._build_patch({'email': 'a', 'n': n}, latest, None, False, None, datetime.now())
+        return (delta[META]['type'], doc)
+
+    def test_snapshot_every_num_deltas_before_snapshot(self):
+        coll = make_collection(num_deltas_before_snapshot=3)
+        (kind, latest) = self.build(coll, None, 0)
+        self.assertEqual((kind, latest[META]['deltas_since_snapshot']), ('snapshot', 0))
+
+        seen = []
+        for n in range(1, 7):
+            (kind, latest) = self.build(coll, latest, n)
+            seen.append((kind, latest[META]['deltas_since_snapshot']))
+
+        self.assertEqual(seen, [('patch', 1), ('patch', 2), ('snapshot', 0),
+                                ('patch', 1), ('patch', 2), ('snapshot', 0)])
+
+    def test_missing_counter_counts_as_just_snapshotted(self):
+        coll = make_collection(num_deltas_before_snapshot=2)
+        latest = live_doc(email='a', n=0)
+        del latest[META]['deltas_since_snapshot']
+
+        (kind, latest) = self.build(coll, latest, 1)
+        self.assertEqual((kind, latest[META]['deltas_since_snapshot']), ('patch', 1))
+        (kind, latest) = self.build(coll, latest, 2)
+        self.assertEqual((kind, latest[META]['deltas_since_snapshot']), ('snapshot', 0))
+
+    def test_one_delta_before_snapshot_snapshots_every_time(self):
+        coll = make_collection(num_deltas_before_snapshot=1)
+        (kind, latest) = self.build(coll, live_doc(email='a', n=0), 1)
+        self.assertEqual((kind, latest[META]['deltas_since_snapshot']), ('snapshot', 0))
+        (kind, latest) = self.build(coll, latest, 2)
+        self.assertEqual((kind, latest[META]['deltas_since_snapshot']), ('snapshot', 0))
+
+
+class PatchOneTest(unittest.TestCase):
+    def patch(self, latest, doc, **kwargs):
+        """Run patch_one against `latest` and return (result, number of find_one calls)."""
+        coll = make_collection()
+        if latest is not None:
+            latest[META]['content_hash'] = coll._content_hash(latest)
+
+        def find_one(fltr, projection=None, **kw):
+            if latest is None or projection is None:
+                return latest
+            return {k: latest[k] for k in projection}
+
+        with mock.patch.object(Collection, 'find_one', side_effect=find_one) as fetch, \
+                mock.patch.object(Collection, 'insert_one'), \
+                mock.patch.object(Collection, 'replace_one'):
+            result = coll.patch_one(doc, session=fake_session(), **kwargs)
+        return (result, fetch.call_count)
+
+    def test_new_doc_is_fetched_once(self):
+        (result, fetches) = self.patch(None, {'email': 'a'})
+        self.assertIsNotNone(result)
+        self.assertEqual(fetches, 1)
+
+    def test_unchanged_doc_is_skipped_on_the_metadata_fetch(self):
+        (result, fetches) = self.patch(live_doc(email='a', name='same'), {'email': 'a', 'name': 'same'})
+        self.assertIsNone(result)
+        self.assertEqual(fetches, 1)
+
+    def test_changed_doc_is_fetched_in_full(self):
+        (result, fetches) = self.patch(live_doc(email='a', name='old'), {'email': 'a', 'name': 'new'})
+        self.assertIsNotNone(result)
+        self.assertEqual(fetches, 2)
+
+    def test_forced_patch_skips_the_metadata_fetch(self):
+        (result, fetches) = self.patch(live_doc(email='a', name='same'), {'email': 'a', 'name': 'same'}, force=True)
+        self.assertIsNotNone(result)
+        self.assertEqual(fetches, 1)
+
+    def test_ignore_fields_skips_the_content_hash(self):
+        latest = live_doc(email='a', name='old', seen=1)
+        (result, fetches) = self.patch(latest, {'email': 'a', 'name': 'old', 'seen': 2}, ignore_fields=['seen'])
+        self.assertIsNone(result)
+        self.assertEqual(fetches, 1)
+
+        (result, fetches) = self.patch(latest, {'email': 'a', 'name': 'new', 'seen': 2}, ignore_fields=['seen'])
+        self.assertIsNotNone(result)
+        self.assertEqual(fetches, 1)
+
+
+class PatchManyTest(unittest.TestCase):
+    def setUp(self):
+        self.coll = make_collection()
+        self.session = fake_session()
+        start_session = mock.patch.object(MongoClient, 'start_session')
+        start_session.start().return_value.__enter__.return_value = self.session
+        self.addCleanup(start_session.stop)
+
+    def test_repeated_pk_replaces_the_same_live_doc(self):
+        live = live_doc(email='a', name='old')
+        docs = [{'email': 'a', 'name': 'first'}, {'email': 'a', 'name': 'second'}]
+        with mock.patch.object(Collection, 'find', return_value=iter([live])), \
+                mock.patch.object(Collection, 'bulk_write') as bulk_write:
+            result = self.coll.patch_many(docs)
+
+        (delta_call, live_call) = bulk_write.call_args_list
+        self.assertEqual(len(delta_call[0][0]), 2)
+        live_ops = live_call[0][0]
+        self.assertEqual([op._filter for op in live_ops], [{'_id': live['_id']}, {'_id': live['_id']}])
+        self.assertEqual([op._doc['name'] for op in live_ops], ['first', 'second'])
+        self.assertEqual(len(result), 1)
+        self.assertEqual(self.session.with_transaction.call_count, 1)
+
+    def test_batch_shares_one_timestamp_without_touching_the_instance(self):
+        constructed_at = self.coll.timestamp
+        docs = [{'email': 'a'}, {'email': 'b'}]
+        with mock.patch.object(Collection, 'find', return_value=iter([])), \
+                mock.patch.object(Collection, 'bulk_write') as bulk_write, \
+                mock.patch.object(Collection, 'update_many') as update_many:
+            self.coll.patch_many(docs, missing_mark_deleted=True)
+
+        (delta_call, live_call) = bulk_write.call_args_list
+        stamps = {op._doc[META]['timestamp'] for op in delta_call[0][0]}
+        stamps |= {op._doc[META]['updated']['timestamp'] for op in live_call[0][0]}
+        stamps.add(update_many.call_args[0][1]['$set'][self.coll._f_deleted]['timestamp'])
+        self.assertEqual(len(stamps), 1)
+        self.assertIs(self.coll.timestamp, constructed_at)
+
+    def test_missing_mark_deleted_treats_pk_values_literally(self):
+        with mock.patch.object(Collection, 'find', return_value=iter([])), \
+                mock.patch.object(Collection, 'bulk_write'), \
+                mock.patch.object(Collection, 'update_many') as update_many:
+            self.coll.patch_many([{'email': '$name'}], missing_mark_deleted=True)
+
+        expr = update_many.call_args[0][0]['$and'][1]['$expr']
+        self.assertEqual(expr, {'$not': {'$in': [['$email'], {'$literal': [['$name']]}]}})
+
+    def test_accepts_a_generator_across_chunks(self):
+        coll = make_collection(patch_many_chunk_size=2)
+        docs = ({'email': e} for e in 'abc')
+        with mock.patch.object(Collection, 'find', side_effect=lambda *a, **kw: iter([])), \
+                mock.patch.object(Collection, 'bulk_write') as bulk_write, \
+                mock.patch.object(Collection, 'update_many') as update_many:
+            result = coll.patch_many(docs, missing_mark_deleted=True)
+
+        live_ops = [op for c in bulk_write.call_args_list[1::2] for op in c[0][0]]
+        self.assertEqual([op._doc['email'] for op in live_ops], ['a', 'b', 'c'])
+        self.assertEqual(self.session.with_transaction.call_count, 2)
+        self.assertEqual(len(result), 3)
+        expr = update_many.call_args[0][0]['$and'][1]['$expr']
+        self.assertEqual(expr['$not']['$in'][1], {'$literal': [['a'], ['b'], ['c']]})
+
+
+if __name__ == '__main__':
+    unittest.main()